@@ -1,6 +1,60 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import plotly.graph_objects as go
+from io import BytesIO
+
+# Maximum number of candles handed to Plotly; longer series are aggregated
+MAX_CANDLES = 2000
+
+@st.cache_data(show_spinner=False)
+def load_and_preprocess(file_bytes):
+    """Read, validate and preprocess the uploaded Parquet file (cached on file content)"""
+    df = pd.read_parquet(BytesIO(file_bytes))
+    
+    # Check required columns
+    required_columns = ['<Ticker>', '<DTYYYYMMDD>', '<Open>', '<High>', '<Low>', '<Close>', '<Volume>']
+    if not all(col in df.columns for col in required_columns):
+        return None
+    
+    # Rename columns
+    df.rename(columns={
+        '<Ticker>': 'Ticker',
+        '<DTYYYYMMDD>': 'Date',
+        '<Open>': 'Open',
+        '<High>': 'High',
+        '<Low>': 'Low',
+        '<Close>': 'Close',
+        '<Volume>': 'Volume'
+    }, inplace=True)
+    
+    # Convert date column (YYYYMMDD integers) with datetime64 arithmetic,
+    # no string round-trip and no pd.to_datetime parsing
+    dates = df['Date'].to_numpy(dtype=np.int64)
+    months = (dates // 10000 - 1970) * 12 + dates // 100 % 100 - 1
+    df['Date'] = (months.astype('M8[M]').astype('M8[D]')
+                  + (dates % 100 - 1).astype('m8[D]')).astype('M8[ns]')
+    
+    # Narrow dtypes: categorical tickers, float32 prices
+    df['Ticker'] = df['Ticker'].astype('category')
+    for col in ('Open', 'High', 'Low', 'Close'):
+        df[col] = df[col].astype('float32')
+    
+    # Index by (Ticker, Date), sorted once; one ticker is df.loc[ticker]
+    return df.set_index(['Ticker', 'Date']).sort_index()
+
+def _aggregate_candles(df, max_buckets=MAX_CANDLES):
+    """Merge consecutive candles into at most max_buckets OHLCV candles"""
+    starts = np.linspace(0, len(df), max_buckets + 1).astype(int)
+    ends = starts[1:] - 1
+    starts = starts[:-1]
+    return pd.DataFrame({
+        'Open': df['Open'].to_numpy()[starts],
+        'High': np.maximum.reduceat(df['High'].to_numpy(), starts),
+        'Low': np.minimum.reduceat(df['Low'].to_numpy(), starts),
+        'Close': df['Close'].to_numpy()[ends],
+        'Volume': np.add.reduceat(df['Volume'].to_numpy(), starts)
+    }, index=df.index[starts])
 
 def main():
     st.title("Candle Stick Chart Dashboard")
@@ -9,41 +63,35 @@ def main():
     uploaded_file = st.file_uploader("Upload a Parquet file", type=["parquet"])
     
     if uploaded_file is not None:
-        df = pd.read_parquet(uploaded_file)
-        
-        # Check required columns
-        required_columns = ['<Ticker>', '<DTYYYYMMDD>', '<Open>', '<High>', '<Low>', '<Close>', '<Volume>']
-        if not all(col in df.columns for col in required_columns):
+        # Parsing is cached, so widget changes do not reload the file
+        df = load_and_preprocess(uploaded_file.getvalue())
+        if df is None:
             st.error("File Parquet không có đúng cấu trúc cột yêu cầu")
             return
         
-        # Rename columns
-        df.rename(columns={
-            '<Ticker>': 'Ticker',
-            '<DTYYYYMMDD>': 'Date',
-            '<Open>': 'Open',
-            '<High>': 'High',
-            '<Low>': 'Low',
-            '<Close>': 'Close',
-            '<Volume>': 'Volume'
-        }, inplace=True)
-        
-        # Convert date column
-        df['Date'] = pd.to_datetime(df['Date'].astype(str), format='%Y%m%d')
-        
-        # Sort data
-        df.sort_values(['Ticker', 'Date'], inplace=True)
-        
         # Filter by ticker
-        ticker = st.selectbox("Select Ticker", df['Ticker'].unique())
-        df_ticker = df[df['Ticker'] == ticker]
+        ticker = st.selectbox("Select Ticker", df.index.levels[0])
+        df_ticker = df.loc[ticker]
+        
+        # Long series are aggregated for plotting; narrowing the range re-aggregates
+        # only the selected window, so zooming in shows full-resolution candles
+        if len(df_ticker) > MAX_CANDLES:
+            start_date, end_date = st.slider(
+                "Date range",
+                min_value=df_ticker.index[0].date(),
+                max_value=df_ticker.index[-1].date(),
+                value=(df_ticker.index[0].date(), df_ticker.index[-1].date())
+            )
+            df_ticker = df_ticker.loc[pd.Timestamp(start_date):pd.Timestamp(end_date)]
+        if len(df_ticker) > MAX_CANDLES:
+            df_ticker = _aggregate_candles(df_ticker)
         
-        # Create candlestick chart
-        fig = go.Figure(data=[go.Candlestick(x=df_ticker['Date'],
-                                             open=df_ticker['Open'],
-                                             high=df_ticker['High'],
-                                             low=df_ticker['Low'],
-                                             close=df_ticker['Close'])])
+        # Create candlestick chart (numpy arrays skip Plotly's Series-to-list conversion)
+        fig = go.Figure(data=[go.Candlestick(x=df_ticker.index.to_numpy(),
+                                             open=df_ticker['Open'].to_numpy(dtype=np.float32, copy=False),
+                                             high=df_ticker['High'].to_numpy(dtype=np.float32, copy=False),
+                                             low=df_ticker['Low'].to_numpy(dtype=np.float32, copy=False),
+                                             close=df_ticker['Close'].to_numpy(dtype=np.float32, copy=False))])
         
         fig.update_layout(title=f"Candle Stick Chart for {ticker}",
                           xaxis_title="Date",
@@ -1,13 +1,24 @@
 import pandas as pd
+import numpy as np
 import plotly.graph_objects as go
+from plotly.subplots import make_subplots
 from datetime import datetime
-import boto3
-from io import BytesIO
+import pyarrow.parquet as pq
+from pyarrow import fs
 import os
+import logging
 
-def get_s3_client():
+logger = logging.getLogger(__name__)
+
+# Các cột cần đọc từ file Parquet, những cột khác sẽ không được tải về
+REQUIRED_COLUMNS = ['<Ticker>', '<DTYYYYMMDD>', '<Open>', '<High>', '<Low>', '<Close>', '<Volume>']
+
+# Số nến tối đa đưa vào Plotly; dữ liệu dài hơn sẽ được gộp lại
+MAX_CANDLES = 2000
+
+def get_s3_filesystem():
     """
-    Khởi tạo S3 client với AWS credentials
+    Khởi tạo S3 filesystem (pyarrow) với AWS credentials
     """
     # Có thể nhập từ biến môi trường hoặc file cấu hình AWS
     aws_access_key_id = os.getenv('AWS_ACCESS_KEY_ID')
@@ -17,94 +28,122 @@ def get_s3_client():
     if not aws_access_key_id or not aws_secret_access_key:
         raise ValueError("AWS credentials chưa được cấu hình")
     
-    return boto3.client(
-        's3',
-        aws_access_key_id=aws_access_key_id,
-        aws_secret_access_key=aws_secret_access_key,
-        region_name=aws_region
+    return fs.S3FileSystem(
+        access_key=aws_access_key_id,
+        secret_key=aws_secret_access_key,
+        region=aws_region
     )
 
-def read_parquet_from_s3(s3_client, bucket_name, file_key):
+def read_parquet_from_s3(s3_fs, bucket_name, file_key):
     """
-    Đọc file Parquet từ S3 và trả về DataFrame
+    Đọc file Parquet từ S3 và trả về DataFrame.
+    Chỉ tải các cột cần thiết
     """
-    try:
-        # Lấy object từ S3
-        response = s3_client.get_object(Bucket=bucket_name, Key=file_key)
-        
-        # Đọc nội dung file vào buffer
-        parquet_buffer = BytesIO(response['Body'].read())
-        
-        # Đọc Parquet từ buffer
-        df = pd.read_parquet(parquet_buffer)
-            
-        required_columns = ['<Ticker>', '<DTYYYYMMDD>', '<Open>', '<High>', '<Low>', '<Close>', '<Volume>']
-        if not all(col in df.columns for col in required_columns):
+    path = f"{bucket_name}/{file_key}"
+    
+    with s3_fs.open_input_file(path) as source:
+        # Chỉ đọc footer để kiểm tra cấu trúc cột; footer được dùng lại cho các bước sau
+        parquet_file = pq.ParquetFile(source, pre_buffer=True)
+        if not all(col in parquet_file.schema_arrow.names for col in REQUIRED_COLUMNS):
             raise ValueError("File Parquet không có đúng cấu trúc cột yêu cầu")
         
-        # Rename columns
-        df.rename(columns={
-            '<Ticker>': 'Ticker',
-            '<DTYYYYMMDD>': 'Date',
-            '<Open>': 'Open',
-            '<High>': 'High',
-            '<Low>': 'Low',
-            '<Close>': 'Close',
-            '<Volume>': 'Volume'
-        }, inplace=True)
-        
-        return df
+        # Chỉ tải các column chunk cần thiết bằng range request, giải mã song song theo row group
+        row_groups = list(range(parquet_file.num_row_groups))
+        table = parquet_file.read_row_groups(row_groups, columns=REQUIRED_COLUMNS, use_threads=True)
     
-    except Exception as e:
-        print(f"Lỗi khi đọc file từ S3: {e}")
-        return None
+    df = table.to_pandas(self_destruct=True, split_blocks=True)
+    del table
+    
+    # Rename columns
+    df.rename(columns={
+        '<Ticker>': 'Ticker',
+        '<DTYYYYMMDD>': 'Date',
+        '<Open>': 'Open',
+        '<High>': 'High',
+        '<Low>': 'Low',
+        '<Close>': 'Close',
+        '<Volume>': 'Volume'
+    }, inplace=True)
+    
+    return df
 
 def preprocess_data(df):
     """
     Tiền xử lý dữ liệu: chuyển đổi ngày, sắp xếp dữ liệu
     """
     # Chuyển đổi cột ngày từ số sang datetime
-    df['Date'] = pd.to_datetime(df['Date'].astype(str), format='%Y%m%d')
+    # (tính trực tiếp bằng datetime64 từ số nguyên YYYYMMDD, không qua chuỗi hay pd.to_datetime)
+    dates = df['Date'].to_numpy(dtype=np.int64)
+    months = (dates // 10000 - 1970) * 12 + dates // 100 % 100 - 1
+    df['Date'] = (months.astype('M8[M]').astype('M8[D]')
+                  + (dates % 100 - 1).astype('m8[D]')).astype('M8[ns]')
+    
+    # Thu hẹp kiểu dữ liệu: mã cổ phiếu dạng category, giá dạng float32
+    df['Ticker'] = df['Ticker'].astype('category')
+    for col in ('Open', 'High', 'Low', 'Close'):
+        df[col] = df[col].astype('float32')
     
-    # Sắp xếp theo mã và ngày
-    df = df.sort_values(['Ticker', 'Date'])
+    # Đặt chỉ mục (mã, ngày) và sắp xếp một lần; lấy dữ liệu một mã bằng df.loc[ticker]
+    df = df.set_index(['Ticker', 'Date']).sort_index()
     
     return df
 
-def filter_data(df, ticker=None, start_date=None, end_date=None):
+def filter_data(df, start_date=None, end_date=None):
     """
-    Lọc dữ liệu theo mã cổ phiếu và khoảng thời gian
+    Lọc dữ liệu của một mã (chỉ mục Date đã được sắp xếp) theo khoảng thời gian
     """
-    if ticker:
-        df = df[df['Ticker'] == ticker]
-    
-    if start_date:
+    if start_date and not isinstance(start_date, pd.Timestamp):
         start_date = pd.to_datetime(start_date)
-        df = df[df['Date'] >= start_date]
     
-    if end_date:
+    if end_date and not isinstance(end_date, pd.Timestamp):
         end_date = pd.to_datetime(end_date)
-        df = df[df['Date'] <= end_date]
     
-    return df
+    return df.loc[start_date:end_date]
+
+def _aggregate_candles(df, max_buckets=MAX_CANDLES):
+    """
+    Gộp các nến liên tiếp thành tối đa max_buckets nến (open đầu, high lớn nhất,
+    low nhỏ nhất, close cuối, volume cộng dồn) để giảm số điểm cần vẽ
+    """
+    starts = np.linspace(0, len(df), max_buckets + 1).astype(int)
+    ends = starts[1:] - 1
+    starts = starts[:-1]
+    
+    return pd.DataFrame({
+        'Open': df['Open'].to_numpy()[starts],
+        'High': np.maximum.reduceat(df['High'].to_numpy(), starts),
+        'Low': np.minimum.reduceat(df['Low'].to_numpy(), starts),
+        'Close': df['Close'].to_numpy()[ends],
+        'Volume': np.add.reduceat(df['Volume'].to_numpy(), starts)
+    }, index=df.index[starts])
+
+def _candlestick_trace(df, name=None):
+    """
+    Tạo trace nến từ DataFrame
+    """
+    return go.Candlestick(
+        x=df.index.to_numpy(),
+        open=df['Open'].to_numpy(dtype=np.float32, copy=False),
+        high=df['High'].to_numpy(dtype=np.float32, copy=False),
+        low=df['Low'].to_numpy(dtype=np.float32, copy=False),
+        close=df['Close'].to_numpy(dtype=np.float32, copy=False),
+        name=name,
+        increasing_line_color='green',
+        decreasing_line_color='red'
+    )
 
 def plot_candlestick(df, title=''):
     """
     Vẽ biểu đồ nến từ DataFrame
     """
     if df.empty:
-        print("Không có dữ liệu để vẽ biểu đồ")
+        logger.warning("Không có dữ liệu để vẽ biểu đồ")
         return
     
-    fig = go.Figure(data=[go.Candlestick(
-        x=df['Date'],
-        open=df['Open'],
-        high=df['High'],
-        low=df['Low'],
-        close=df['Close'],
-        increasing_line_color='green',
-        decreasing_line_color='red'
-    )])
+    if len(df) > MAX_CANDLES:
+        df = _aggregate_candles(df)
+    
+    fig = go.Figure(data=[_candlestick_trace(df)])
     
     fig.update_layout(
         title=title,
@@ -116,12 +155,46 @@ def plot_candlestick(df, title=''):
     
     fig.show()
 
+def plot_candlesticks(frames, title=''):
+    """
+    Vẽ biểu đồ nến cho nhiều mã trong một figure duy nhất
+    (mỗi mã một hàng, dùng chung trục thời gian)
+    """
+    if not frames:
+        logger.warning("Không có dữ liệu để vẽ biểu đồ")
+        return
+    
+    rows = len(frames)
+    fig = make_subplots(
+        rows=rows,
+        cols=1,
+        shared_xaxes=True,
+        # Plotly yêu cầu vertical_spacing <= 1 / (rows - 1)
+        vertical_spacing=min(0.01, 0.5 / max(rows - 1, 1)),
+        subplot_titles=list(frames)
+    )
+    
+    for row, (ticker, df) in enumerate(frames.items(), start=1):
+        if len(df) > MAX_CANDLES:
+            df = _aggregate_candles(df)
+        fig.add_trace(_candlestick_trace(df, name=ticker), row=row, col=1)
+    
+    fig.update_xaxes(rangeslider_visible=False)
+    fig.update_layout(
+        title=title,
+        height=300 * rows,
+        showlegend=False,
+        template='plotly_white'
+    )
+    
+    fig.show()
+
 def main():
-    # Khởi tạo S3 client
+    # Khởi tạo S3 filesystem
     try:
-        s3_client = get_s3_client()
+        s3_fs = get_s3_filesystem()
     except Exception as e:
-        print(f"Lỗi khi kết nối AWS S3: {e}")
+        logger.error("Lỗi khi kết nối AWS S3: %s", e)
         return
     
     # Nhập thông tin bucket và file từ người dùng
@@ -129,15 +202,17 @@ def main():
     file_key = input("Nhập đường dẫn file trong S3 (key): ").strip()
     
     # Đọc file Parquet từ S3
-    df = read_parquet_from_s3(s3_client, bucket_name, file_key)
-    if df is None:
+    try:
+        df = read_parquet_from_s3(s3_fs, bucket_name, file_key)
+    except Exception as e:
+        logger.error("Lỗi khi đọc file từ S3: %s", e)
         return
     
     # Tiền xử lý dữ liệu
     df = preprocess_data(df)
     
     # Lấy danh sách các mã cổ phiếu
-    tickers = df['Ticker'].unique()
+    tickers = df.index.levels[0]
     print(f"Tìm thấy {len(tickers)} mã cổ phiếu trong file:")
     print(", ".join(tickers))
     
@@ -154,12 +229,19 @@ def main():
             start_date = input("Nhập ngày bắt đầu (YYYY-MM-DD, để trống nếu không cần): ").strip()
             end_date = input("Nhập ngày kết thúc (YYYY-MM-DD, để trống nếu không cần): ").strip()
             
+            # Chuyển đổi ngày một lần thay vì cho từng mã
+            start_ts = pd.to_datetime(start_date) if start_date else None
+            end_ts = pd.to_datetime(end_date) if end_date else None
+            
+            # Gom tất cả các mã vào một figure, chỉ gọi fig.show() một lần
+            frames = {}
             for ticker in tickers:
-                filtered_df = filter_data(df, ticker, start_date or None, end_date or None)
+                filtered_df = filter_data(df.loc[ticker], start_ts, end_ts)
                 if not filtered_df.empty:
-                    plot_candlestick(filtered_df, f'Biểu đồ nến {ticker}')
+                    frames[ticker] = filtered_df
                 else:
-                    print(f"Không có dữ liệu cho mã {ticker} trong khoảng thời gian đã chọn")
+                    logger.info("Không có dữ liệu cho mã %s trong khoảng thời gian đã chọn", ticker)
+            plot_candlesticks(frames, 'Biểu đồ nến các mã cổ phiếu')
         
         elif choice == '2':
             # Vẽ một mã cụ thể
@@ -171,7 +253,7 @@ def main():
             start_date = input("Nhập ngày bắt đầu (YYYY-MM-DD, để trống nếu không cần): ").strip()
             end_date = input("Nhập ngày kết thúc (YYYY-MM-DD, để trống nếu không cần): ").strip()
             
-            filtered_df = filter_data(df, ticker, start_date or None, end_date or None)
+            filtered_df = filter_data(df.loc[ticker], start_date or None, end_date or None)
             plot_candlestick(filtered_df, f'Biểu đồ nến {ticker}')
         
         elif choice == '3':
@@ -182,4 +264,5 @@ def main():
             print("Lựa chọn không hợp lệ, vui lòng chọn lại")
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
     main()
\ No newline at end of file
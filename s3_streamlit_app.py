@@ -1,17 +1,58 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import plotly.graph_objects as go
 from datetime import datetime
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 from io import BytesIO
+import contextlib
 import os
-import hashlib
 import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+import pyarrow as pa
+import pyarrow.feather as feather
+import pyarrow.parquet as pq
 from dotenv import load_dotenv
 # Tải biến môi trường từ file .env
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
+# Các cột cần đọc từ file Parquet, những cột khác sẽ không được giải mã
+REQUIRED_COLUMNS = ['<Ticker>', '<DTYYYYMMDD>', '<Open>', '<High>', '<Low>', '<Close>', '<Volume>']
+
+# Số nến tối đa đưa vào Plotly; dữ liệu dài hơn sẽ được gộp lại
+MAX_CANDLES = 2000
+
+# Tăng giá trị này khi thay đổi preprocess_data để bỏ các cache Arrow cũ
+PREPROCESSED_CACHE_VERSION = 2
+
+# Một client dùng chung cho HEAD/GET: pool đủ lớn cho các luồng tải song song,
+# giữ kết nối (TLS) sống giữa các request và tự thử lại khi bị giới hạn tốc độ
+S3_CLIENT_CONFIG = Config(
+    max_pool_connections=32,
+    retries={'mode': 'adaptive', 'max_attempts': 5},
+    tcp_keepalive=True
+)
+
+# Tải file lớn bằng nhiều range GET song song (8 MiB mỗi phần).
+# Dữ liệu được ghi thẳng xuống file theo từng khối 1 MiB; hàng đợi ghi giới hạn
+# ở 16 khối nên bộ nhớ đệm tối đa khoảng 16 MiB, không phụ thuộc kích thước file
+S3_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=8 * 1024 * 1024,
+    multipart_chunksize=8 * 1024 * 1024,
+    max_concurrency=16,
+    io_chunksize=1024 * 1024,
+    max_io_queue=16,
+    use_threads=True
+)
+
 class S3ParquetHandler:
     def __init__(self):
         # Validate required environment variables
@@ -21,7 +62,15 @@ class S3ParquetHandler:
         local_cache_dir = os.getenv('LOCAL_CACHE_DIR', '~/.s3_parquet_cache')
         self.local_cache_dir = os.path.expanduser(local_cache_dir)
         os.makedirs(self.local_cache_dir, exist_ok=True)
-        self._has_local_cache_file = True
+        # Trong khoảng thời gian này sau lần kiểm tra gần nhất, dùng cache mà không gọi HEAD lên S3
+        self.cache_ttl_seconds = float(os.getenv('CACHE_TTL_SECONDS', '300'))
+        self._download_lock = threading.Lock()
+        
+        # Tải trước file mặc định ở luồng nền trong lúc chương trình còn khởi tạo giao diện
+        self._prefetch_key = (os.getenv('S3_BUCKET_NAME'), os.getenv('S3_FILE_KEY'))
+        executor = ThreadPoolExecutor(max_workers=1)
+        self._prefetch = executor.submit(self._download_from_s3, *self._prefetch_key)
+        executor.shutdown(wait=False)
 
     def _validate_env_vars(self):
         """Validate required environment variables"""
@@ -51,7 +100,8 @@ class S3ParquetHandler:
             's3',
             aws_access_key_id=aws_access_key_id,
             aws_secret_access_key=aws_secret_access_key,
-            region_name=aws_region
+            region_name=aws_region,
+            config=S3_CLIENT_CONFIG
         )
     
     def _get_s3_file_metadata(self, bucket_name, file_key):
@@ -64,7 +114,7 @@ class S3ParquetHandler:
                 'etag': response['ETag'].strip('"')
             }
         except Exception as e:
-            print(f"Lỗi khi lấy metadata từ S3: {e}")
+            logger.warning("Lỗi khi lấy metadata từ S3: %s", e)
             return None
     
     def _get_local_file_metadata(self, local_path):
@@ -72,14 +122,11 @@ class S3ParquetHandler:
         if not os.path.exists(local_path):
             return None
             
+        # Chỉ dùng stat; việc so sánh thay đổi dựa trên ETag đã lưu trong file .meta
         stat = os.stat(local_path)
-        with open(local_path, 'rb') as f:
-            md5_hash = hashlib.md5(f.read()).hexdigest()
-        
         return {
             'last_modified': stat.st_mtime,
-            'size': stat.st_size,
-            'etag': md5_hash
+            'size': stat.st_size
         }
     
     def _has_file_changed(self, bucket_name, file_key, local_path):
@@ -93,8 +140,20 @@ class S3ParquetHandler:
             return True  # File local không tồn tại
         
         # So sánh các thuộc tính quan trọng
-        return not (s3_meta['etag'] == local_meta['etag'] and 
-                   s3_meta['size'] == local_meta['size'])
+        changed = not (s3_meta['etag'] == local_meta['etag'] and 
+                       s3_meta['size'] == local_meta['size'])
+        if not changed:
+            # Ghi nhận thời điểm kiểm tra để bỏ qua HEAD trong thời gian TTL
+            local_meta['last_check_ts'] = time.time()
+            self._save_metadata(local_path, local_meta)
+        return changed
+    
+    def _is_cache_fresh(self, local_path):
+        """Kiểm tra lần so sánh với S3 gần nhất còn nằm trong thời gian TTL không"""
+        local_meta = self._load_metadata(local_path)
+        if not local_meta:
+            return False
+        return time.time() - local_meta.get('last_check_ts', 0) < self.cache_ttl_seconds
     
     def _get_local_cache_path(self, bucket_name, file_key):
         """Tạo đường dẫn cache local từ thông tin S3"""
@@ -116,107 +175,222 @@ class S3ParquetHandler:
         with open(meta_path, 'r') as f:
             return json.load(f)
     
-    def has_local_cache_file(self):
-        return self._has_local_cache_file
-
-    def download_from_s3(self, bucket_name, file_key, force_download=False):
+    def download_from_s3(self, bucket_name, file_key, force_download=False, check_remote=False):
+        """
+        Tải file từ S3 xuống local nếu có thay đổi hoặc chưa có.
+        Nếu check_remote=False và cache vừa được kiểm tra trong thời gian TTL
+        thì dùng luôn bản cache mà không gọi HEAD lên S3.
+        Trả về (đường dẫn file local, True nếu file vừa được tải từ S3)
+        """
+        # Handler có thể được dùng chung giữa nhiều luồng (mỗi phiên Streamlit một luồng):
+        # lock giữ cho việc nhận lần tải trước và việc tải file không chạy song song
+        with self._download_lock:
+            prefetch, self._prefetch = self._prefetch, None
+            if prefetch is not None:
+                # Chờ lần tải trước hoàn tất để không ghi cùng một file từ hai luồng
+                try:
+                    local_path, downloaded = prefetch.result()
+                    # File vừa được tải mới từ S3 thì không cần tải lại, kể cả khi force_download
+                    if (bucket_name, file_key) == self._prefetch_key and (
+                            downloaded or not (force_download or check_remote)):
+                        return local_path, downloaded
+                except Exception as e:
+                    logger.warning("Tải trước thất bại, thử tải lại: %s", e)
+            
+            return self._download_from_s3(bucket_name, file_key, force_download, check_remote)
+    
+    def _download_from_s3(self, bucket_name, file_key, force_download=False, check_remote=False):
         """
-        Tải file từ S3 xuống local nếu có thay đổi hoặc chưa có
-        Trả về đường dẫn file local
+        Thực hiện việc kiểm tra cache và tải file (có thể chạy ở luồng nền).
+        Trả về (đường dẫn file local, True nếu file vừa được tải từ S3)
         """
-        self._has_local_cache_file = True
         local_path = self._get_local_cache_path(bucket_name, file_key)
         
         # Kiểm tra nếu cần tải lại file
         if not force_download and os.path.exists(local_path):
+            if not check_remote and self._is_cache_fresh(local_path):
+                logger.info("Sử dụng bản cache local cho %s/%s", bucket_name, file_key)
+                return local_path, False
             if not self._has_file_changed(bucket_name, file_key, local_path):
-                print(f"Sử dụng bản cache local cho {bucket_name}/{file_key}")
-                return local_path
+                logger.info("Sử dụng bản cache local cho %s/%s", bucket_name, file_key)
+                return local_path, False
         
-        print(f"Tải file mới từ S3: {bucket_name}/{file_key}")
-        self._has_local_cache_file = False
-        try:
-            # Tải file từ S3
-            response = self.s3_client.get_object(Bucket=bucket_name, Key=file_key)
-            file_content = response['Body'].read()
-            
-            # Lưu file xuống local
-            with open(local_path, 'wb') as f:
-                f.write(file_content)
-            
-            # Lưu metadata
-            s3_meta = self._get_s3_file_metadata(bucket_name, file_key)
-            if s3_meta:
-                self._save_metadata(local_path, s3_meta)
+        logger.info("Tải file mới từ S3: %s/%s", bucket_name, file_key)
+        # Xoá metadata và cache Arrow cũ trước khi tải, để chúng không mô tả nhầm file mới
+        for stale_path in (f"{local_path}.meta", self._get_preprocessed_path(local_path)):
+            if os.path.exists(stale_path):
+                os.remove(stale_path)
+        
+        # Lấy ETag trước và sau khi tải; chỉ lưu .meta khi hai lần trùng nhau,
+        # nên .meta luôn khớp với file parquet nằm cạnh nó.
+        # (download_file không nhận IfMatch; file tải dở được s3transfer ghi ra
+        # file tạm nên không cần tự xoá khi lỗi)
+        s3_meta = self._get_s3_file_metadata(bucket_name, file_key)
+        
+        # Tải file từ S3 xuống local bằng nhiều luồng song song
+        self.s3_client.download_file(bucket_name, file_key, local_path, Config=S3_TRANSFER_CONFIG)
+        
+        # Lưu metadata
+        s3_meta_after = self._get_s3_file_metadata(bucket_name, file_key)
+        if s3_meta and s3_meta_after and s3_meta['etag'] == s3_meta_after['etag']:
+            s3_meta['last_check_ts'] = time.time()
+            self._save_metadata(local_path, s3_meta)
+        else:
+            logger.warning("Không xác nhận được ETag của %s/%s, sẽ kiểm tra lại ở lần đọc sau",
+                           bucket_name, file_key)
+        
+        return local_path, True
+    
+    def read_parquet(self, bucket_name, file_key, force_download=False, check_remote=False):
+        """
+        Đọc file Parquet từ S3 hoặc cache local.
+        Chỉ giải mã các cột cần thiết
+        """
+        local_path, _ = self.download_from_s3(bucket_name, file_key, force_download, check_remote)
+        return self._read_parquet_file(local_path)
+    
+    def _read_parquet_file(self, local_path):
+        """Đọc file Parquet đã cache ở local và đổi tên cột"""
+        # Memory-map file cache thay vì đọc qua buffer I/O
+        with pa.memory_map(local_path, 'r') as source:
+            parquet_file = pq.ParquetFile(source)
+            if not all(col in parquet_file.schema_arrow.names for col in REQUIRED_COLUMNS):
+                raise ValueError("File Parquet không có đúng cấu trúc cột yêu cầu")
             
-            return local_path
+            # Giải mã song song theo row group
+            row_groups = list(range(parquet_file.num_row_groups))
+            table = parquet_file.read_row_groups(row_groups, columns=REQUIRED_COLUMNS, use_threads=True)
+        
+        df = table.to_pandas(self_destruct=True, split_blocks=True)
+        del table
+        
+        # Rename columns
+        df.rename(columns={
+            '<Ticker>': 'Ticker',
+            '<DTYYYYMMDD>': 'Date',
+            '<Open>': 'Open',
+            '<High>': 'High',
+            '<Low>': 'Low',
+            '<Close>': 'Close',
+            '<Volume>': 'Volume'
+        }, inplace=True)
+        
+        return df
+    
+    def _get_preprocessed_path(self, local_path):
+        """Đường dẫn file Arrow IPC chứa dữ liệu đã tiền xử lý"""
+        return f"{local_path}.arrow"
+    
+    def save_preprocessed(self, local_path, df):
+        """Lưu DataFrame đã tiền xử lý dưới dạng Arrow IPC, gắn với ETag trong file .meta"""
+        metadata = self._load_metadata(local_path)
+        if not metadata:
+            return
+        
+        try:
+            table = pa.Table.from_pandas(df, preserve_index=True)
+            table = table.replace_schema_metadata({
+                **(table.schema.metadata or {}),
+                b'etag': metadata['etag'].encode(),
+                b'version': str(PREPROCESSED_CACHE_VERSION).encode()
+            })
+            feather.write_feather(table, self._get_preprocessed_path(local_path), compression='lz4')
         except Exception as e:
-            print(f"Lỗi khi tải file từ S3: {e}")
-            if os.path.exists(local_path):
-                os.remove(local_path)
-            return None
+            logger.warning("Lỗi khi lưu cache Arrow: %s", e)
     
-    def read_parquet(self, bucket_name, file_key, force_download=False):
+    def load_preprocessed(self, local_path):
         """
-        Đọc file Parquet từ S3 hoặc cache local
+        Đọc DataFrame đã tiền xử lý từ file Arrow IPC (memory-map).
+        Trả về None nếu chưa có cache hoặc cache không khớp ETag hiện tại
         """
-        local_path = self.download_from_s3(bucket_name, file_key, force_download)
-        if not local_path:
+        arrow_path = self._get_preprocessed_path(local_path)
+        metadata = self._load_metadata(local_path)
+        if not metadata or not os.path.exists(arrow_path):
             return None
         
         try:
-            df = pd.read_parquet(local_path)
-            
-            required_columns = ['<Ticker>', '<DTYYYYMMDD>', '<Open>', '<High>', '<Low>', '<Close>', '<Volume>']
-            if not all(col in df.columns for col in required_columns):
-                raise ValueError("File Parquet không có đúng cấu trúc cột yêu cầu")
-            
-            # Rename columns
-            df.rename(columns={
-                '<Ticker>': 'Ticker',
-                '<DTYYYYMMDD>': 'Date',
-                '<Open>': 'Open',
-                '<High>': 'High',
-                '<Low>': 'Low',
-                '<Close>': 'Close',
-                '<Volume>': 'Volume'
-            }, inplace=True)
-                
-            return df
+            with pa.memory_map(arrow_path, 'r') as source:
+                reader = pa.ipc.open_file(source)
+                cached_meta = reader.schema.metadata or {}
+                if (cached_meta.get(b'etag') == metadata['etag'].encode() and
+                        cached_meta.get(b'version') == str(PREPROCESSED_CACHE_VERSION).encode()):
+                    table = reader.read_all()
+                    return table.to_pandas(zero_copy_only=False, self_destruct=True)
         except Exception as e:
-            print(f"Lỗi khi đọc file Parquet: {e}")
-            return None
+            logger.warning("Lỗi khi đọc cache Arrow: %s", e)
+        
+        # Cache đã cũ hoặc bị hỏng (có thể đã bị luồng khác xoá)
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(arrow_path)
+        return None
+    
+    def load_data(self, bucket_name, file_key, force_download=False, check_remote=False):
+        """
+        Trả về DataFrame đã tiền xử lý, ưu tiên bản cache Arrow IPC
+        để bỏ qua bước giải mã Parquet và chuyển đổi ngày
+        """
+        local_path, _ = self.download_from_s3(bucket_name, file_key, force_download, check_remote)
+        
+        df = self.load_preprocessed(local_path)
+        if df is not None:
+            logger.info("Sử dụng dữ liệu đã tiền xử lý từ cache cho %s/%s", bucket_name, file_key)
+            return df
+        
+        df = preprocess_data(self._read_parquet_file(local_path))
+        self.save_preprocessed(local_path, df)
+        return df
 
 def preprocess_data(df):
     """Tiền xử lý dữ liệu: chuyển đổi ngày, sắp xếp dữ liệu"""
-    df['Date'] = pd.to_datetime(df['Date'].astype(str), format='%Y%m%d')
-    df = df.sort_values(['Ticker', 'Date'])
+    # Tính ngày trực tiếp bằng datetime64 từ số nguyên YYYYMMDD, không qua chuỗi hay pd.to_datetime
+    dates = df['Date'].to_numpy(dtype=np.int64)
+    months = (dates // 10000 - 1970) * 12 + dates // 100 % 100 - 1
+    df['Date'] = (months.astype('M8[M]').astype('M8[D]')
+                  + (dates % 100 - 1).astype('m8[D]')).astype('M8[ns]')
+    # Thu hẹp kiểu dữ liệu: mã cổ phiếu dạng category, giá dạng float32
+    df['Ticker'] = df['Ticker'].astype('category')
+    for col in ('Open', 'High', 'Low', 'Close'):
+        df[col] = df[col].astype('float32')
+    # Chỉ mục (mã, ngày) đã sắp xếp: lấy dữ liệu một mã bằng df.loc[ticker]
+    df = df.set_index(['Ticker', 'Date']).sort_index()
     return df
 
-def filter_data(df, ticker=None, start_date=None, end_date=None):
-    """Lọc dữ liệu theo mã cổ phiếu và khoảng thời gian"""
-    if ticker:
-        df = df[df['Ticker'] == ticker]
-    if start_date:
+def filter_data(df, start_date=None, end_date=None):
+    """Lọc dữ liệu của một mã (chỉ mục Date đã được sắp xếp) theo khoảng thời gian"""
+    if start_date and not isinstance(start_date, pd.Timestamp):
         start_date = pd.to_datetime(start_date)
-        df = df[df['Date'] >= start_date]
-    if end_date:
+    if end_date and not isinstance(end_date, pd.Timestamp):
         end_date = pd.to_datetime(end_date)
-        df = df[df['Date'] <= end_date]
-    return df
+    return df.loc[start_date:end_date]
+
+def _aggregate_candles(df, max_buckets=MAX_CANDLES):
+    """Gộp các nến liên tiếp thành tối đa max_buckets nến để giảm số điểm cần vẽ"""
+    starts = np.linspace(0, len(df), max_buckets + 1).astype(int)
+    ends = starts[1:] - 1
+    starts = starts[:-1]
+    return pd.DataFrame({
+        'Open': df['Open'].to_numpy()[starts],
+        'High': np.maximum.reduceat(df['High'].to_numpy(), starts),
+        'Low': np.minimum.reduceat(df['Low'].to_numpy(), starts),
+        'Close': df['Close'].to_numpy()[ends],
+        'Volume': np.add.reduceat(df['Volume'].to_numpy(), starts)
+    }, index=df.index[starts])
 
 def plot_candlestick(st, df, title=''):
     """Vẽ biểu đồ nến từ DataFrame"""
     if df.empty:
-        print("Không có dữ liệu để vẽ biểu đồ")
+        logger.warning("Không có dữ liệu để vẽ biểu đồ")
         return
     
+    if len(df) > MAX_CANDLES:
+        df = _aggregate_candles(df)
+    
     fig = go.Figure(data=[go.Candlestick(
-        x=df['Date'],
-        open=df['Open'],
-        high=df['High'],
-        low=df['Low'],
-        close=df['Close'],
+        x=df.index.to_numpy(),
+        open=df['Open'].to_numpy(dtype=np.float32, copy=False),
+        high=df['High'].to_numpy(dtype=np.float32, copy=False),
+        low=df['Low'].to_numpy(dtype=np.float32, copy=False),
+        close=df['Close'].to_numpy(dtype=np.float32, copy=False),
         increasing_line_color='green',
         decreasing_line_color='red'
     )])
@@ -231,30 +405,67 @@ def plot_candlestick(st, df, title=''):
     st.plotly_chart(fig)
     st.success("Biểu đồ nến đã được tạo thành công!")
 
+@st.cache_resource(show_spinner=False)
+def get_handler():
+    """Giữ một S3ParquetHandler duy nhất qua các lần rerun của Streamlit"""
+    return S3ParquetHandler()
+
+@st.cache_resource(show_spinner=False, max_entries=1)
+def load_data(bucket_name, file_key, etag, mtime):
+    """
+    Đọc dữ liệu đã tiền xử lý; kết quả được giữ lại giữa các lần rerun.
+    etag/mtime của file cache chỉ dùng làm khoá: khi file trên S3 thay đổi
+    và được tải lại, khoá đổi nên dữ liệu được đọc lại.
+    Dùng cache_resource để mỗi rerun không phải unpickle lại cả DataFrame;
+    DataFrame trả về được dùng chung nên không được sửa tại chỗ
+    """
+    # Lỗi được raise ra ngoài nên không bị cache, lần rerun sau sẽ thử lại
+    return get_handler().load_data(bucket_name, file_key)
+
 def main():
-    handler = S3ParquetHandler()
+    try:
+        handler = get_handler()
+    except ValueError as e:
+        st.error(str(e))
+        return
     
     # Nhập thông tin bucket và file từ người dùng
     bucket_name = os.getenv('S3_BUCKET_NAME', 'your-bucket-name')
     file_key = os.getenv('S3_FILE_KEY', 'stock_data_20062025.parquet')    
-    # Đọc file Parquet từ S3 hoặc cache local
-    df = handler.read_parquet(bucket_name, file_key, False)
-    if df is None:
+    # Đọc dữ liệu đã tiền xử lý từ S3 hoặc cache local
+    try:
+        # Mỗi rerun đều kiểm tra cache (chỉ gọi HEAD khi đã quá CACHE_TTL_SECONDS)
+        local_path, downloaded = handler.download_from_s3(bucket_name, file_key)
+        etag = (handler._load_metadata(local_path) or {}).get('etag')
+        df = load_data(bucket_name, file_key, etag, os.stat(local_path).st_mtime_ns)
+    except Exception as e:
+        logger.error("Lỗi khi đọc dữ liệu: %s", e)
+        st.error(f"Không đọc được dữ liệu từ {bucket_name}/{file_key}: {e}")
         return
     
-    # Tiền xử lý dữ liệu
-    df = preprocess_data(df)
-    
     # Lấy danh sách các mã cổ phiếu
-    tickers = df['Ticker'].unique()
+    tickers = df.index.levels[0]
     
     # Streamlit
-    st.title(f"S3 Candle Stick Chart Dashboard {' - Local cache' if handler.has_local_cache_file() else ' - New donwload S3'}")
+    st.title(f"S3 Candle Stick Chart Dashboard {' - Local cache' if not downloaded else ' - New donwload S3'}")
 
     # Filter by ticker
-    ticker = st.selectbox("Select Ticker", df['Ticker'].unique())
-    df_ticker = df[df['Ticker'] == ticker]
+    ticker = st.selectbox("Select Ticker", tickers)
+    df_ticker = df.loc[ticker]
+    
+    # Chuỗi dài sẽ bị gộp nến khi vẽ; chọn khoảng thời gian hẹp hơn để xem chi tiết
+    # (mỗi lần thay đổi chỉ khoảng được chọn được gộp lại ở phía server)
+    if len(df_ticker) > MAX_CANDLES:
+        start_date, end_date = st.slider(
+            "Date range",
+            min_value=df_ticker.index[0].date(),
+            max_value=df_ticker.index[-1].date(),
+            value=(df_ticker.index[0].date(), df_ticker.index[-1].date())
+        )
+        df_ticker = filter_data(df_ticker, start_date, end_date)
+    
     plot_candlestick(st, df_ticker, title=f"Candle Stick Chart for {ticker}") 
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
     main()
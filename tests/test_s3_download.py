@@ -0,0 +1,66 @@
+import os
+import sys
+
+import pytest
+
+pytest.importorskip("dotenv")
+pytest.importorskip("plotly")
+boto3 = pytest.importorskip("boto3")
+pa = pytest.importorskip("pyarrow")
+pq = pytest.importorskip("pyarrow.parquet")
+moto = pytest.importorskip("moto")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+BUCKET = "test-bucket"
+KEY = "stock_data.parquet"
+
+
+@pytest.fixture
+def s3(tmp_path, monkeypatch):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setenv("AWS_REGION", "us-east-1")
+    monkeypatch.setenv("S3_BUCKET_NAME", BUCKET)
+    monkeypatch.setenv("S3_FILE_KEY", KEY)
+    monkeypatch.setenv("LOCAL_CACHE_DIR", str(tmp_path / "cache"))
+
+    with moto.mock_aws():
+        client = boto3.client("s3", region_name="us-east-1")
+        client.create_bucket(Bucket=BUCKET)
+        table = pa.table({
+            "<Ticker>": ["AAA", "AAA", "BBB"],
+            "<DTYYYYMMDD>": [20250102, 20250103, 20250102],
+            "<Open>": [1.0, 2.0, 3.0],
+            "<High>": [1.5, 2.5, 3.5],
+            "<Low>": [0.5, 1.5, 2.5],
+            "<Close>": [1.2, 2.2, 3.2],
+            "<Volume>": [100, 200, 300],
+        })
+        pq.write_table(table, tmp_path / KEY)
+        client.upload_file(str(tmp_path / KEY), BUCKET, KEY)
+        yield client
+
+
+def test_load_data_downloads_and_writes_meta(s3):
+    from s3_dashboard_local import S3ParquetHandler
+
+    handler = S3ParquetHandler()
+    df = handler.load_data(BUCKET, KEY)
+
+    assert list(df.index.levels[0]) == ["AAA", "BBB"]
+    local_path = handler._get_local_cache_path(BUCKET, KEY)
+    etag = s3.head_object(Bucket=BUCKET, Key=KEY)["ETag"].strip('"')
+    assert handler._load_metadata(local_path)["etag"] == etag
+    assert os.path.exists(handler._get_preprocessed_path(local_path))
+
+
+
+def test_download_from_s3_reuses_unchanged_cache(s3):
+    from s3_dashboard_local import S3ParquetHandler
+
+    handler = S3ParquetHandler()
+    handler.download_from_s3(BUCKET, KEY)
+    _, downloaded = handler.download_from_s3(BUCKET, KEY, check_remote=True)
+
+    assert not downloaded